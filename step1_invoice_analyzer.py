@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 
 import zipfile
+import csv
+import hashlib
+import json
 import os
 import re
 import fitz  # PyMuPDF
 import pandas as pd
-import openpyxl
-from openpyxl.chart import LineChart, Reference
 import argparse
+import functools
 import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 
+@functools.lru_cache(maxsize=1024)
+def _parse_data_italiana(s: str) -> datetime:
+    """Parsa una data in formato italiano 'GG.MM.AAAA'. Le cifre sono già state
+       validate dalla regex del periodo, quindi costruiamo il datetime direttamente
+       dalle fette numeriche (molto più economico dell'interpretazione del format
+       string di strptime); la cache copre le date ripetute tra sotto-bollette.
+       Solleva ValueError per date impossibili, come strptime."""
+    return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]))
+
+
 class InvoiceAnalyzer:
 
     INTESTAZIONE_BOLLETTA_ELETTRICA = "Bolletta energia elettrica"
@@ -26,97 +40,207 @@ class InvoiceAnalyzer:
     FORMATO_LEGACY = "legacy"
     FORMATO_2026 = "hera_2026"
 
+    # Tutte le regex vengono compilate una volta sola a livello di classe:
+    # vengono applicate su ogni pagina / sotto-bolletta e la compilazione ripetuta
+    # (o il lookup nella piccola cache interna di `re`) sarebbe un costo inutile.
+    _REGEX_FLAGS = re.IGNORECASE | re.DOTALL
+
     REGEX_PERIODO = {
-        FORMATO_LEGACY: r"Periodo:\s*dal\s*(\d{2}\.\d{2}\.\d{4})\s*al\s*(\d{2}\.\d{2}\.\d{4})",
-        FORMATO_2026: r"Periodo\s+oggetto\s+di\s+fatturazione:\s*dal\s*(\d{2}\.\d{2}\.\d{4})\s*al\s*(\d{2}\.\d{2}\.\d{4})",
+        FORMATO_LEGACY: re.compile(r"Periodo:\s*dal\s*(\d{2}\.\d{2}\.\d{4})\s*al\s*(\d{2}\.\d{2}\.\d{4})", _REGEX_FLAGS),
+        FORMATO_2026: re.compile(r"Periodo\s+oggetto\s+di\s+fatturazione:\s*dal\s*(\d{2}\.\d{2}\.\d{4})\s*al\s*(\d{2}\.\d{2}\.\d{4})", _REGEX_FLAGS),
     }
 
+    # Nomi delle voci di spesa estratte da ogni sotto-bolletta
+    VOCI_SPESA = ("materia_energia", "trasporto_e_contatore", "oneri_di_sistema", "imposte_e_iva", "totale_bolletta")
+
+    # Le cinque regex delle voci di spesa sono fuse in un'unica alternanza con
+    # gruppi nominati per formato: un solo passaggio finditer sul testo della
+    # sotto-bolletta invece di cinque scansioni complete.
     REGEX_SPESE_IN_EURO = {
-        FORMATO_LEGACY: {
-            "materia_energia": r"Spesa per la materia energia\s+([-\d.,]+)\s*€",
-            "trasporto_e_contatore": r"Spesa per il trasporto e la gestione del contatore\s+([-\d.,]+)\s*€",
-            "oneri_di_sistema": r"Spesa per oneri di sistema\s+([-\d.,]+)\s*€",
-            "imposte_e_iva": r"Totale imposte e IVA\s+([-\d.,]+)\s*€",
-            "totale_bolletta": r"Totale bolletta/contratto\s+([-\d.,]+)\s*€",
-        },
-        FORMATO_2026: {
-            "materia_energia": r"Quota per consumi\s+[-\d.,]+\s*kWh\s+([-\d.,]+)\s*€",
-            "trasporto_e_contatore": r"Quota fissa e quota potenza\s+[-\d.,]+\s*mesi\s+([-\d.,]+)\s*€",
-            "oneri_di_sistema": r"[-\d.,]+\s*kW\s+per\s+[-\d.,]+\s*mesi\s+([-\d.,]+)\s*€",
-            "imposte_e_iva": r"Accise e IVA\s+([-\d.,]+)\s*€",
-            "totale_bolletta": r"Totale bolletta\s+([-\d.,]+)\s*€",
-        },
+        FORMATO_LEGACY: re.compile(
+            r"Spesa per la materia energia\s+(?P<materia_energia>[-\d.,]+)\s*€"
+            r"|Spesa per il trasporto e la gestione del contatore\s+(?P<trasporto_e_contatore>[-\d.,]+)\s*€"
+            r"|Spesa per oneri di sistema\s+(?P<oneri_di_sistema>[-\d.,]+)\s*€"
+            r"|Totale imposte e IVA\s+(?P<imposte_e_iva>[-\d.,]+)\s*€"
+            r"|Totale bolletta/contratto\s+(?P<totale_bolletta>[-\d.,]+)\s*€",
+            _REGEX_FLAGS),
+        FORMATO_2026: re.compile(
+            r"Quota per consumi\s+[-\d.,]+\s*kWh\s+(?P<materia_energia>[-\d.,]+)\s*€"
+            r"|Quota fissa e quota potenza\s+[-\d.,]+\s*mesi\s+(?P<trasporto_e_contatore>[-\d.,]+)\s*€"
+            r"|[-\d.,]+\s*kW\s+per\s+[-\d.,]+\s*mesi\s+(?P<oneri_di_sistema>[-\d.,]+)\s*€"
+            r"|Accise e IVA\s+(?P<imposte_e_iva>[-\d.,]+)\s*€"
+            r"|Totale bolletta\s+(?P<totale_bolletta>[-\d.,]+)\s*€",
+            _REGEX_FLAGS),
     }
 
+    # Le due varianti di layout per ogni formato sono fuse in un'unica regex con
+    # alternanza: un solo passaggio sul testo invece di due scansioni in sequenza.
+    # I sei gruppi di cattura vengono ridotti ai tre valorizzati dopo il match.
     REGEX_CONSUMI_IN_KWH = {
-        FORMATO_LEGACY: [
-            r"Consumo fatturato.*?([-\d.,]+)\s+([-\d.,]+)\s+([-\d.,]+)\s*kWh",
-            # Alcune volte il formato è leggermente diverso... proviamo con una regex alternativa
-            r"Consumo fatturato\s*\(Chilowatt\s+orari\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)\s*kWh",
-        ],
-        FORMATO_2026: [
-            r"Consumo fatturato\s*\(Chilowatt\s*orari\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)",
-            r"F1\s*\(kWh\)\s*F2\+F3\s*\(kWh\)\s*Totale\s*\(kWh\).*?\(\d+\s+giorni\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)",
-        ],
+        FORMATO_LEGACY: re.compile(
+            r"Consumo fatturato.*?([-\d.,]+)\s+([-\d.,]+)\s+([-\d.,]+)\s*kWh"
+            # Alcune volte il formato è leggermente diverso... alternativa:
+            r"|Consumo fatturato\s*\(Chilowatt\s+orari\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)\s*kWh",
+            _REGEX_FLAGS),
+        FORMATO_2026: re.compile(
+            r"Consumo fatturato\s*\(Chilowatt\s*orari\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)"
+            r"|F1\s*\(kWh\)\s*F2\+F3\s*\(kWh\)\s*Totale\s*\(kWh\).*?\(\d+\s+giorni\)\s*([-\d.,]+)\s*([-\d.,]+)\s*([-\d.,]+)",
+            _REGEX_FLAGS),
     }
 
-    def __init__(self, verbose: int = 0, dump_debug: bool = False):
+    REGEX_FORMATO_2026 = re.compile(r"Periodo\s+oggetto\s+di\s+fatturazione", re.IGNORECASE)
+
+    # Regex unica per la classificazione delle pagine: un solo passaggio su page_text
+    # rileva intestazione gas, marker della bolletta elettrica e marker del periodo,
+    # invece di scandire il testo della pagina una volta per ogni marker.
+    REGEX_PAGINA = re.compile(
+        r"(?P<gas>Bolletta gas)"
+        r"|(?P<ele>Bolletta energia elettrica|Energia elettrica|Scontrino dell[’']energia)"
+        r"|(?i:(?P<per>Periodo(?:\s+oggetto\s+di\s+fatturazione)?:\s*dal\s*\d{2}\.\d{2}\.\d{4}\s*al\s*\d{2}\.\d{2}\.\d{4}))"
+    )
+
+    # Da incrementare quando cambia la logica di identificazione delle sotto-bollette,
+    # per invalidare le cache scritte dalle versioni precedenti.
+    CACHE_VERSION = 1
+
+    def __init__(self, verbose: int = 0, dump_debug: bool = False, scan_all_pages: bool = False, use_cache: bool = True):
         self.verbose = verbose
         self.dump_debug = dump_debug
+        self.scan_all_pages = scan_all_pages
+        self.use_cache = use_cache
 
     def __italian_number_to_float_safe(self, s: str) -> float:
-        """Converte una stringa con numero in formato italiano (es. '1.234,56') in float"""
-        try:
-            return float(s.replace(".", "").replace(",", "."))
-        except ValueError:
+        """Converte una stringa con numero in formato italiano (es. '1.234,56') in float.
+           Singolo passaggio sui caratteri, senza le due stringhe intermedie che
+           creerebbe str.replace()."""
+        n = 0
+        dec = -1
+        neg = False
+        saw_digit = False
+        for c in s:
+            if "0" <= c <= "9":
+                n = n * 10 + (ord(c) - 48)
+                saw_digit = True
+                if dec >= 0:
+                    dec += 1
+            elif c == ",":
+                if dec >= 0:
+                    saw_digit = False  # seconda virgola: numero non valido
+                    break
+                dec = 0
+            elif c == ".":
+                pass  # separatore delle migliaia: ignorato
+            elif c == "-" and not neg and not saw_digit and dec < 0:
+                neg = True
+            else:
+                saw_digit = False  # carattere inatteso
+                break
+
+        if not saw_digit:
             if self.verbose > 0:
                 print(f"⚠️ Attenzione: impossibile convertire '{s}' in float.")
             return None
 
+        value = float(n)
+        if dec > 0:
+            value /= 10 ** dec
+        return -value if neg else value
+
     def __detect_pdf_format(self, text: str) -> str:
         """Rileva automaticamente il formato del PDF in base ai marker testuali."""
-        if re.search(r"Periodo\s+oggetto\s+di\s+fatturazione", text, flags=re.IGNORECASE):
+        if InvoiceAnalyzer.REGEX_FORMATO_2026.search(text):
             return InvoiceAnalyzer.FORMATO_2026
         return InvoiceAnalyzer.FORMATO_LEGACY
 
-    def __search_first_match(self, regex_list: list[str], text: str):
+    def __search_first_match(self, regex_list: list[re.Pattern], text: str):
         for regex in regex_list:
-            m = re.search(regex, text, flags=re.IGNORECASE | re.DOTALL)
+            m = regex.search(text)
             if m:
                 return m
         return None
 
-    def __extract_spesa_with_fallback(self, text: str, voce_spesa: str, formato: str) -> float:
-        # Prima prova il formato rilevato, poi i regex degli altri formati come fallback.
+    def __estrai_voci_spesa(self, text: str, formato: str) -> dict:
+        # Prima prova il formato rilevato, poi i regex degli altri formati come
+        # fallback per le voci rimaste senza valore. Per ogni voce conta la prima
+        # occorrenza nel testo, come facevano le cinque search separate.
+        voci_spesa = {}
         ordered_formats = [formato] + [f for f in InvoiceAnalyzer.REGEX_SPESE_IN_EURO.keys() if f != formato]
         for fmt in ordered_formats:
-            regex = InvoiceAnalyzer.REGEX_SPESE_IN_EURO[fmt][voce_spesa]
-            match = re.search(regex, text, flags=re.IGNORECASE | re.DOTALL)
-            if match:
-                return self.__italian_number_to_float_safe(match.group(1))
-        return 0.0
-
-    def __estrai_testo_delle_sotto_bollette(self, pdf_path: str) -> list[str]:
+            if len(voci_spesa) == len(InvoiceAnalyzer.VOCI_SPESA):
+                break
+            for m in InvoiceAnalyzer.REGEX_SPESE_IN_EURO[fmt].finditer(text):
+                voce = m.lastgroup
+                if voce not in voci_spesa:
+                    voci_spesa[voce] = self.__italian_number_to_float_safe(m.group(voce))
+        for voce in InvoiceAnalyzer.VOCI_SPESA:
+            voci_spesa.setdefault(voce, 0.0)
+        return voci_spesa
+
+    def __estrai_testo_delle_sotto_bollette(self, pdf_path: str, nome_file: str, pdf_stream: bytes = None) -> list[str]:
         """Estrae i dati richiesti da una singola bolletta PDF Hera e ritorna una lista
-           di stringhe contenenti il contenuto di ogni sotto-bolletta identificata"""
-
-        nome_file = os.path.basename(pdf_path)
+           di stringhe contenenti il contenuto di ogni sotto-bolletta identificata.
+           Se pdf_stream è fornito, il PDF viene letto da quel buffer (es. membro di
+           uno ZIP) senza passare dal filesystem."""
 
         if self.verbose > 1:
             print("***")
         print(f"🔍 Inizio l'analisi di {pdf_path}...")
 
+        # L'estrazione testo PyMuPDF è il costo dominante: sulle ri-esecuzioni
+        # (es. aggiungendo --grafici) riusiamo il testo già estratto, salvato in
+        # .cache/ con chiave (percorso, mtime, dimensione).
+        cache_file = self.__cache_file_path(pdf_path) if pdf_stream is None else None
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    sotto_bollette = json.load(f)
+                if self.verbose > 1:
+                    print(f"💬 Testo di {nome_file} riusato dalla cache: {cache_file}")
+                self.__dump_debug_files(pdf_path, sotto_bollette)
+                return sotto_bollette
+            except (OSError, ValueError):
+                pass  # cache corrotta: riestraiamo dal PDF
+
         sotto_bollette = []
-        with fitz.open(pdf_path) as doc:
-            text = ""
+        doc_handle = fitz.open(stream=pdf_stream, filetype="pdf") if pdf_stream is not None else fitz.open(pdf_path)
+        with doc_handle as doc:
+            # Accumula le pagine in una lista e concatena con "".join: la
+            # concatenazione ripetuta di stringhe sarebbe O(K²) sul numero di pagine.
+            parts = []
             collecting_electric_bill = False
-            for i in range(len(doc)):
-                page_text = doc[i].get_text()
-                has_period_marker = self.__search_first_match(list(InvoiceAnalyzer.REGEX_PERIODO.values()), page_text) is not None
-                has_electricity_marker = any(marker in page_text for marker in InvoiceAnalyzer.MARKER_BOLLETTA_ELETTRICA)
+            # Itera direttamente sulle pagine (evita la ri-risoluzione doc[i] per indice)
+            # e chiede esplicitamente la modalità "text", la più economica: per il
+            # matching regex servono solo i caratteri, non layout o posizioni.
+            for i, page in enumerate(doc):
+                page_text = page.get_text("text")
+
+                # Classifica la pagina con un solo passaggio della regex combinata.
+                # Prefiltro economico: l'operatore `in` su str usa una ricerca di
+                # sottostringa a livello C molto più veloce della regex, quindi le
+                # pagine che sicuramente non contengono marker (es. condizioni
+                # contrattuali) vengono scartate senza entrare nel motore regex.
+                has_gas_marker = has_electricity_marker = has_period_marker = False
+                if "Bolletta" in page_text or "nergia" in page_text or "Periodo" in page_text or "Scontrino" in page_text:
+                    for m in InvoiceAnalyzer.REGEX_PAGINA.finditer(page_text):
+                        if m.lastgroup == "gas":
+                            has_gas_marker = True
+                        elif m.lastgroup == "ele":
+                            has_electricity_marker = True
+                        elif m.lastgroup == "per":
+                            has_period_marker = True
+                        if has_gas_marker and has_electricity_marker and has_period_marker:
+                            break
 
                 # Se incontro intestazione gas → escludo
-                if InvoiceAnalyzer.INTESTAZIONE_BOLLETTA_GAS in page_text:
+                if has_gas_marker:
+                    if collecting_electric_bill and not self.scan_all_pages:
+                        # Nelle bollette Hera la sezione gas segue quella elettrica:
+                        # possiamo interrompere la scansione ed evitare il costo di
+                        # get_text() sulle pagine di coda (usa --scan-all-pages per
+                        # forzare la scansione completa).
+                        if self.verbose > 1:
+                            print(f"💬 Interrompo la scansione alla pagina {i} (inizio sezione GAS) in {nome_file}")
+                        break
                     if self.verbose > 1:
                         print(f"💬 Escludo pagina {i} con intestazione GAS in {nome_file}")
                     continue # skip
@@ -133,38 +257,66 @@ class InvoiceAnalyzer:
                 if has_period_marker:
                     # trovato un periodo, è l'inizio di una nuova sotto-bolletta,
                     # salva il testo precedente (se esiste) come sotto-bolletta
-                    if text:
-                        sotto_bollette.append(text)
-                        text = ""
+                    if parts:
+                        sotto_bollette.append("".join(parts))
+                        parts.clear()
 
-                text += page_text
+                if page_text:
+                    # pagine vuote (es. solo grafica): niente da accumulare
+                    parts.append(page_text)
 
-            if text:
+            if parts:
                 # salva l'ultima sotto-bolletta
-                sotto_bollette.append(text)
+                sotto_bollette.append("".join(parts))
                 
         if self.verbose > 1:
             print(f"💬 Trovate {len(sotto_bollette)} sotto-bollette in {nome_file}")
 
-        if self.dump_debug:
-            for i, sb in enumerate(sotto_bollette):
-                # scrivi il testo estratto in un file di debug
-                debug_file = pdf_path.replace(".pdf", f"_debug_{i + 1}.txt")
-                print(f"💬 Testo sotto-bolletta {i + 1} estratto nel file di debug: {debug_file}")
-                with open(debug_file, "w", encoding="utf-8") as f:
-                    f.write(sb)
+        if cache_file is not None:
+            # Scrittura atomica (tmp + rename) per non lasciare cache parziali
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp_file = f"{cache_file}.tmp{os.getpid()}"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(sotto_bollette, f)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                pass  # la cache è solo un'ottimizzazione: mai fallire per essa
+
+        self.__dump_debug_files(pdf_path, sotto_bollette)
 
         return sotto_bollette
 
-    def __estrai_dati_da_sotto_bolletta(self, pdf_path: str, text: str) -> dict:
-        nome_file = os.path.basename(pdf_path)
+    def __cache_file_path(self, pdf_path: str) -> str:
+        """Percorso del file di cache per pdf_path, o None se la cache è disabilitata
+           o il file non è accessibile."""
+        if not self.use_cache:
+            return None
+        try:
+            st = os.stat(pdf_path)
+        except OSError:
+            return None
+        key = f"{os.path.abspath(pdf_path)}|{st.st_mtime_ns}|{st.st_size}|{self.scan_all_pages}|{InvoiceAnalyzer.CACHE_VERSION}"
+        return os.path.join(".cache", hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def __dump_debug_files(self, pdf_path: str, sotto_bollette: list[str]) -> None:
+        if not self.dump_debug:
+            return
+        for i, sb in enumerate(sotto_bollette):
+            # scrivi il testo estratto in un file di debug
+            debug_file = pdf_path.replace(".pdf", f"_debug_{i + 1}.txt")
+            print(f"💬 Testo sotto-bolletta {i + 1} estratto nel file di debug: {debug_file}")
+            with open(debug_file, "w", encoding="utf-8") as f:
+                f.write(sb)
+
+    def __estrai_dati_da_sotto_bolletta(self, pdf_path: str, nome_file: str, text: str) -> dict:
         formato = self.__detect_pdf_format(text)
 
         if self.verbose > 1:
             print(f"💬 Formato PDF rilevato per {nome_file}: {formato}")
 
         # Periodo (inizio e fine)
-        periodo_match = re.search(InvoiceAnalyzer.REGEX_PERIODO[formato], text, flags=re.IGNORECASE | re.DOTALL)
+        periodo_match = InvoiceAnalyzer.REGEX_PERIODO[formato].search(text)
         if not periodo_match:
             # Fallback: prova i regex periodo degli altri formati.
             periodo_match = self.__search_first_match(list(InvoiceAnalyzer.REGEX_PERIODO.values()), text)
@@ -174,8 +326,8 @@ class InvoiceAnalyzer:
             periodo_fine_str = periodo_match.group(2)
 
             try:
-                periodo_inizio = datetime.strptime(periodo_inizio_str, "%d.%m.%Y")
-                periodo_fine = datetime.strptime(periodo_fine_str, "%d.%m.%Y")
+                periodo_inizio = _parse_data_italiana(periodo_inizio_str)
+                periodo_fine = _parse_data_italiana(periodo_fine_str)
             except ValueError:
                 if self.verbose > 0:
                     print(f"⚠️ Attenzione: formato data non valido nella bolletta {nome_file}.")
@@ -194,20 +346,22 @@ class InvoiceAnalyzer:
             return None  # Se non troviamo il periodo, la bolletta non è valida
 
         # Consumi per fasce e totale
-        consumi_match = self.__search_first_match(InvoiceAnalyzer.REGEX_CONSUMI_IN_KWH[formato], text)
+        consumi_match = InvoiceAnalyzer.REGEX_CONSUMI_IN_KWH[formato].search(text)
         if not consumi_match:
             # Fallback: prova anche i regex consumi degli altri formati.
-            for fmt, regexes in InvoiceAnalyzer.REGEX_CONSUMI_IN_KWH.items():
+            for fmt, regex in InvoiceAnalyzer.REGEX_CONSUMI_IN_KWH.items():
                 if fmt == formato:
                     continue
-                consumi_match = self.__search_first_match(regexes, text)
+                consumi_match = regex.search(text)
                 if consumi_match:
                     break
 
         if consumi_match:
-            consumo_f1 = self.__italian_number_to_float_safe(consumi_match.group(1))
-            consumo_f23 = self.__italian_number_to_float_safe(consumi_match.group(2))
-            consumo_tot = self.__italian_number_to_float_safe(consumi_match.group(3))
+            # Con l'alternanza solo una tripletta di gruppi è valorizzata
+            valori = [g for g in consumi_match.groups() if g is not None]
+            consumo_f1 = self.__italian_number_to_float_safe(valori[0])
+            consumo_f23 = self.__italian_number_to_float_safe(valori[1])
+            consumo_tot = self.__italian_number_to_float_safe(valori[2])
         else:
             if self.verbose > 0:
                 print(f"⚠️ Attenzione: impossibile trovare i consumi nella bolletta {nome_file}.")
@@ -224,9 +378,7 @@ class InvoiceAnalyzer:
         #     return None  # Se non troviamo il totale, la bolletta non è valida
 
         # Voci di spesa
-        voci_spesa = {}
-        for voce_spesa in InvoiceAnalyzer.REGEX_SPESE_IN_EURO[formato].keys():
-            voci_spesa[voce_spesa] = self.__extract_spesa_with_fallback(text, voce_spesa, formato)
+        voci_spesa = self.__estrai_voci_spesa(text, formato)
 
         # Fine estrazione
         if self.verbose > 1:
@@ -247,17 +399,28 @@ class InvoiceAnalyzer:
             "totale_bolletta_eur": voci_spesa['totale_bolletta'], # float
         }
 
-    def estrai_dati_bolletta(self, pdf_path: str) -> list[dict]:
+    def estrai_dati_bolletta(self, pdf_path, pdf_stream: bytes = None) -> list[dict]:
         """Estrae i dati richiesti da una singola bolletta PDF Hera
            e ritorna per ogni sotto-bolletta identificata un dict coi campi estratti.
-           Questa è l'unica API pubblica della classe."""
+           Questa è l'unica API pubblica della classe.
+           pdf_path può essere un percorso su disco oppure, se pdf_stream contiene i
+           byte del PDF, un semplice nome identificativo (es. membro di uno ZIP)."""
+
+        # Accetta anche la coppia (nome, bytes) come unico argomento, comoda con
+        # executor.map sui membri di uno ZIP.
+        if isinstance(pdf_path, tuple):
+            pdf_path, pdf_stream = pdf_path
+
+        # Il basename serve solo per i messaggi: calcolato una volta sola qui
+        # invece che una volta per sotto-bolletta nei metodi privati.
+        nome_file = os.path.basename(pdf_path)
 
         # Ogni bolletta può essere composta da più sotto-bollette (es. luce + gas)
         # oppure (luce + luce)
         dati = []
-        sotto_bollette = self.__estrai_testo_delle_sotto_bollette(pdf_path)
+        sotto_bollette = self.__estrai_testo_delle_sotto_bollette(pdf_path, nome_file, pdf_stream)
         for sotto_bol in sotto_bollette:
-            dati_sotto_bol = self.__estrai_dati_da_sotto_bolletta(pdf_path, sotto_bol)
+            dati_sotto_bol = self.__estrai_dati_da_sotto_bolletta(pdf_path, nome_file, sotto_bol)
             if dati_sotto_bol:
                 dati.append(dati_sotto_bol)
         return dati
@@ -269,127 +432,151 @@ class Tools:
     def __init__(self, dati_bollette: list[dict], verbose: int = 0):
         self.dati_bollette = dati_bollette
         self.verbose = verbose
+        self._df_bollette = None
+
+    def __dataframe_bollette(self) -> pd.DataFrame:
+        """DataFrame delle bollette, costruito pigramente e condiviso tra i metodi
+           che ne hanno bisogno (la costruzione da lista di dict rifà inferenza dei
+           tipi e copie ad ogni chiamata). I chiamanti non devono mutarlo."""
+        if self._df_bollette is None:
+            self._df_bollette = pd.DataFrame(self.dati_bollette)
+        return self._df_bollette
 
     def crea_csv(self, csv_path: str) -> None:
-        # Creazione DataFrame e salvataggio CSV
-        df = pd.DataFrame(self.dati_bollette)
-        df.to_csv(csv_path, index=False)
+        # csv.DictWriter scrive la stessa tabella senza costruire un DataFrame
+        # (block manager, inferenza dei dtype) per poi buttarlo via subito.
+        # Le date restano in formato ISO come le scriveva pandas.
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.dati_bollette[0].keys()), lineterminator="\n")
+            writer.writeheader()
+            for dati in self.dati_bollette:
+                writer.writerow({
+                    k: (v.strftime("%Y-%m-%d") if isinstance(v, datetime) else v)
+                    for k, v in dati.items()
+                })
         print(f"✅ File CSV creato: {csv_path}")
 
-    def crea_excel(self, excel_path: str) -> None:
-        # Creazione DataFrame e salvataggio Excel
-        df = pd.DataFrame(self.dati_bollette)
-        df.to_excel(excel_path, index=False)
-        print(f"✅ File Excel creato: {excel_path}")
-
-    def aggiungi_grafici(self, excel_path: str) -> None:
-        """Aggiunge grafici di consumi e costi all'Excel"""
-        wb = openpyxl.load_workbook(excel_path)
-        ws = wb.active
-
-        # Creiamo una colonna con i periodi come etichette (periodo_inizio - periodo_fine)
-        for i in range(2, ws.max_row + 1):
-            periodo = f"{ws.cell(row=i, column=2).value} - {ws.cell(row=i, column=3).value}"
-            ws.cell(row=i, column=8, value=periodo)
-
-        cats = Reference(ws, min_col=8, min_row=2, max_row=ws.max_row)
-
-        # === Grafico Consumi ===
-        chart_consumi = LineChart()
-        chart_consumi.title = "Andamento Consumi"
-        chart_consumi.y_axis.title = "kWh"
-        chart_consumi.x_axis.title = "Periodo"
-
-        data_consumi = Reference(ws, min_col=6, min_row=1, max_row=ws.max_row)  # Consumo Totale
-        chart_consumi.add_data(data_consumi, titles_from_data=True)
-        chart_consumi.set_categories(cats)
-
-        ws.add_chart(chart_consumi, "J2")
-
-        # === Grafico Costi ===
-        chart_costi = LineChart()
-        chart_costi.title = "Andamento Costi Energia"
-        chart_costi.y_axis.title = "Euro"
-        chart_costi.x_axis.title = "Periodo"
-
-        data_costi = Reference(ws, min_col=7, min_row=1, max_row=ws.max_row)  # Totale Energia
-        chart_costi.add_data(data_costi, titles_from_data=True)
-        chart_costi.set_categories(cats)
-
-        ws.add_chart(chart_costi, "J20")
-
-        wb.save(excel_path)
-        print(f"📊 Grafici aggiunti a {excel_path}")
+    def crea_excel(self, excel_path: str, grafici: bool = False) -> None:
+        """Crea l'Excel riepilogativo, con eventuali grafici di consumi e costi,
+           in un singolo passaggio di scrittura (engine xlsxwriter): evita il ciclo
+           carica/modifica/salva dell'intero workbook che serviva per i grafici."""
+        df = self.__dataframe_bollette()
+        with pd.ExcelWriter(excel_path, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False, sheet_name="Bollette")
+
+            if grafici:
+                workbook = writer.book
+                worksheet = writer.sheets["Bollette"]
+                num_righe = len(df)
+
+                # Colonna extra con i periodi come etichette (periodo_inizio - periodo_fine)
+                col_etichette = len(df.columns)
+                etichette = [
+                    f"{inizio:%Y-%m-%d} - {fine:%Y-%m-%d}"
+                    for inizio, fine in zip(df["periodo_inizio"], df["periodo_fine"])
+                ]
+                worksheet.write(0, col_etichette, "periodo")
+                worksheet.write_column(1, col_etichette, etichette)
+
+                col_consumo = df.columns.get_loc("consumo_totale_kwh")
+                col_costo = df.columns.get_loc("totale_bolletta_eur")
+
+                # === Grafico Consumi ===
+                chart_consumi = workbook.add_chart({"type": "line"})
+                chart_consumi.set_title({"name": "Andamento Consumi"})
+                chart_consumi.set_y_axis({"name": "kWh"})
+                chart_consumi.set_x_axis({"name": "Periodo"})
+                chart_consumi.add_series({
+                    "name": ["Bollette", 0, col_consumo],
+                    "categories": ["Bollette", 1, col_etichette, num_righe, col_etichette],
+                    "values": ["Bollette", 1, col_consumo, num_righe, col_consumo],
+                })
+                worksheet.insert_chart("J2", chart_consumi)
+
+                # === Grafico Costi ===
+                chart_costi = workbook.add_chart({"type": "line"})
+                chart_costi.set_title({"name": "Andamento Costi Energia"})
+                chart_costi.set_y_axis({"name": "Euro"})
+                chart_costi.set_x_axis({"name": "Periodo"})
+                chart_costi.add_series({
+                    "name": ["Bollette", 0, col_costo],
+                    "categories": ["Bollette", 1, col_etichette, num_righe, col_etichette],
+                    "values": ["Bollette", 1, col_costo, num_righe, col_costo],
+                })
+                worksheet.insert_chart("J20", chart_costi)
+
+        print(f"✅ File Excel creato: {excel_path}" + (" (con grafici)" if grafici else ""))
 
     def controlla_copertura(self) -> list[tuple[datetime, datetime]]:
         """Verifica se ci sono buchi temporali tra le bollette"""
 
-        df = pd.DataFrame(self.dati_bollette)
-        df["periodo_inizio"] = pd.to_datetime(df["periodo_inizio"], format="%d.%m.%Y")
-        df["periodo_fine"] = pd.to_datetime(df["periodo_fine"], format="%d.%m.%Y")
-
-        # Ordinamento cronologico
-        df = df.sort_values("periodo_inizio").reset_index(drop=True)
-
+        # I dict contengono già oggetti datetime: basta ordinare e scandire le
+        # coppie consecutive, senza costruire un DataFrame né riparsare le date.
+        righe = sorted(self.dati_bollette, key=lambda d: d["periodo_inizio"])
+        un_giorno = timedelta(days=1)
         gaps = []
-        for i in range(1, len(df)):
-            prev_end = df.loc[i-1, "periodo_fine"]
-            curr_start = df.loc[i, "periodo_inizio"]
-
-            if curr_start > prev_end + timedelta(days=1):
-                gaps.append((prev_end + timedelta(days=1), curr_start - timedelta(days=1)))
-
+        for prec, succ in zip(righe, righe[1:]):
+            if succ["periodo_inizio"] > prec["periodo_fine"] + un_giorno:
+                gaps.append((prec["periodo_fine"] + un_giorno, succ["periodo_inizio"] - un_giorno))
         return gaps
 
     def rinomina_pdfs(self) -> None:
         """Rinomina i file PDF delle bollette in base ai dati estratti."""
-        temp_dict = {}
 
         def normalize_path(path: str) -> str:
             return os.path.normcase(os.path.normpath(path))
 
+        # Primo passaggio: per ogni sorgente il nome proposto (dal primo periodo
+        # estratto) e il numero di sotto-bollette che contiene.
+        per_sorgente = {}
         for dati in self.dati_bollette:
             source_file = dati.get("file") or dati.get("File")
             if not source_file:
                 raise KeyError("Missing 'file' key in extracted invoice data")
 
+            if source_file in per_sorgente:
+                per_sorgente[source_file]["count"] += 1
+                continue
+
             curr_path = os.path.dirname(source_file)
             periodo_inizio = dati["periodo_inizio"].strftime("%Y%m%d")
             periodo_fine = dati["periodo_fine"].strftime("%Y%m%d")
             anno = dati["periodo_inizio"].year
             mese = dati["periodo_inizio"].month
             nuovo_nome = os.path.join(curr_path, f"elettricita_{anno}_{mese:02}_{periodo_inizio}_{periodo_fine}.pdf")
+            per_sorgente[source_file] = {"new_name": nuovo_nome, "count": 1}
 
-            if source_file in temp_dict:
-                temp_dict[source_file]["count"] += 1
-            else:
-                temp_dict[source_file] = {"new_name":nuovo_nome, "count":1}
-
-        for old_name, info in temp_dict.items():
+        # Secondo passaggio: raggruppa per destinazione, così le collisioni tra
+        # sorgenti diverse vengono risolte in memoria prima di qualunque syscall.
+        per_destinazione = defaultdict(list)
+        for old_name, info in per_sorgente.items():
             nuovo_nome = info["new_name"]
             if info["count"] > 1:
                 base, ext = os.path.splitext(nuovo_nome)
                 nuovo_nome = f"{base}_{info['count']}_sottobollette{ext}"
+            per_destinazione[nuovo_nome].append(old_name)
 
-            old_normalized = normalize_path(old_name)
-            new_normalized = normalize_path(nuovo_nome)
+        for destinazione, sorgenti in per_destinazione.items():
+            base, ext = os.path.splitext(destinazione)
+            for k, old_name in enumerate(sorgenti):
+                # Più sorgenti con la stessa destinazione proposta: numerale
+                nuovo_nome = destinazione if len(sorgenti) == 1 else f"{base}_{k + 1}{ext}"
 
-            if old_normalized != new_normalized:
-                if os.path.exists(nuovo_nome):
+                if normalize_path(old_name) == normalize_path(nuovo_nome):
+                    print(f"ℹ️ Il file {old_name} ha già il nome corretto.")
+                elif os.path.exists(nuovo_nome):
                     print(f"⚠️ Impossibile rinominare {old_name} in {nuovo_nome}: il file di destinazione esiste già.")
                 else:
                     os.rename(old_name, nuovo_nome)
                     print(f"🔄 Rinominato {old_name} in {nuovo_nome}")
-            else:
-                print(f"ℹ️ Il file {old_name} ha già il nome corretto.")
 
     def genera_sommario(self, summary_type: str, summary_format: str) -> None:
         """Genera un sommario testuale delle bollette analizzate."""
         if summary_type == "detailed":
-            # Stampa un sommario testuale
-            df = pd.DataFrame(self.dati_bollette)
+            # Stampa un sommario testuale (assign: non muta il DataFrame condiviso)
+            df = self.__dataframe_bollette()
             if "file" in df.columns:
-                df["nome_file_pdf"] = df["file"].apply(os.path.basename)
+                df = df.assign(nome_file_pdf=df["file"].apply(os.path.basename))
             df = df.sort_values("periodo_inizio").reset_index(drop=True)
             print("\n📄 Sommario Bollette:")
             columns = ["nome_file_pdf", "periodo_inizio", "periodo_fine", "consumo_totale_kwh", "totale_bolletta_eur", "numero_giorni"]
@@ -427,6 +614,8 @@ def main():
     parser.add_argument("--summary-format", default="text", help="Formato del sommario", choices=["text", "html"])
     parser.add_argument("--verbose", type=int, help="Enable verbose output", default=0)
     parser.add_argument("--dump-debug", help="Salva i testi estratti delle sotto-bollette in file TXT di debug", action='store_true')
+    parser.add_argument("--scan-all-pages", help="Scandisci tutte le pagine del PDF anche dopo la fine della bolletta elettrica", action='store_true')
+    parser.add_argument("--no-cache", help="Non riusare/salvare il testo estratto nella cartella .cache", action='store_true')
     parser.add_argument("--grafici", help="Aggiungi grafici nell'output", action='store_true')
     parser.add_argument("--rinomina",  help="Rinomina i files PDF con un formato human-friendly", action='store_true')
     args = parser.parse_args()
@@ -437,17 +626,30 @@ def main():
     pdf_list = []
 
     if zipfile.is_zipfile(input_path):
-        # Se è uno ZIP -> estraiamo i file
-        extract_dir = "bollette_pdf"
-        with zipfile.ZipFile(input_path, "r") as zip_ref:
-            zip_ref.extractall(extract_dir)
-
-        pdf_list = [os.path.join(extract_dir, f) for f in sorted(os.listdir(extract_dir)) if f.endswith(".pdf")]
+        if args.rinomina:
+            # La rinomina richiede file reali su disco -> estraiamo i file
+            extract_dir = "bollette_pdf"
+            with zipfile.ZipFile(input_path, "r") as zip_ref:
+                zip_ref.extractall(extract_dir)
+
+            with os.scandir(extract_dir) as it:
+                pdf_list = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(".pdf"))
+        else:
+            # Se è uno ZIP -> leggiamo i membri in memoria come coppie (nome, bytes),
+            # evitando il ciclo scrittura+rilettura su disco di extractall
+            with zipfile.ZipFile(input_path, "r") as zip_ref:
+                pdf_list = [
+                    (info.filename, zip_ref.read(info))
+                    for info in sorted(zip_ref.infolist(), key=lambda info: info.filename)
+                    if info.filename.endswith(".pdf")
+                ]
 
     elif os.path.isdir(input_path):
-        # Se è una cartella -> analizziamo tutti i files PDF al suo interno
-        pdf_dir = input_path
-        pdf_list = [os.path.join(pdf_dir, f) for f in sorted(os.listdir(pdf_dir)) if f.endswith(".pdf")]
+        # Se è una cartella -> analizziamo tutti i files PDF al suo interno.
+        # os.scandir riusa i metadati della directory entry (niente stat extra
+        # per file, utile su share di rete) e accetta anche l'estensione .PDF.
+        with os.scandir(input_path) as it:
+            pdf_list = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(".pdf"))
 
     elif os.path.isfile(input_path) and input_path.endswith(".pdf"):
         # Se è un singolo file PDF, analizziamo solo quello
@@ -457,19 +659,40 @@ def main():
         print("❌ Errore: devi fornire uno ZIP valido o una cartella contenente PDF.")
         sys.exit(1)
 
-    # Elaborazione dei PDF
-    x = InvoiceAnalyzer(verbose=args.verbose, dump_debug=args.dump_debug)
+    # Elaborazione dei PDF.
+    # Ogni PDF è indipendente dagli altri e l'analisi è CPU-bound (estrazione testo
+    # PyMuPDF + regex), quindi con più PDF usiamo un pool di processi; per un singolo
+    # PDF restiamo sequenziali per evitare il costo di avvio del pool.
+    x = InvoiceAnalyzer(verbose=args.verbose, dump_debug=args.dump_debug, scan_all_pages=args.scan_all_pages, use_cache=not args.no_cache)
     dati_bollette = []
     pdf_falliti = []
     print(f"✅ {len(pdf_list)} PDF files to analyze")
-    for pdf_path in pdf_list:
-        try:
-            dati = x.estrai_dati_bolletta(pdf_path)
-        except Exception as e:
-            print(f"❌ Errore durante l'analisi del PDF {pdf_path}: {e}")
-            pdf_falliti.append(pdf_path)
-            continue
 
+    def nome_pdf(pdf_entry) -> str:
+        # pdf_entry può essere un percorso oppure una coppia (nome, bytes) da ZIP
+        return pdf_entry[0] if isinstance(pdf_entry, tuple) else pdf_entry
+
+    if len(pdf_list) > 1:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [(nome_pdf(pdf_entry), executor.submit(x.estrai_dati_bolletta, pdf_entry)) for pdf_entry in pdf_list]
+            risultati = []
+            for pdf_path, future in futures:
+                try:
+                    risultati.append((pdf_path, future.result()))
+                except Exception as e:
+                    print(f"❌ Errore durante l'analisi del PDF {pdf_path}: {e}")
+                    pdf_falliti.append(pdf_path)
+    else:
+        risultati = []
+        for pdf_entry in pdf_list:
+            pdf_path = nome_pdf(pdf_entry)
+            try:
+                risultati.append((pdf_path, x.estrai_dati_bolletta(pdf_entry)))
+            except Exception as e:
+                print(f"❌ Errore durante l'analisi del PDF {pdf_path}: {e}")
+                pdf_falliti.append(pdf_path)
+
+    for pdf_path, dati in risultati:
         if dati:
             for d in dati:
                 dati_bollette.append(d)
@@ -494,10 +717,7 @@ def main():
         t.crea_csv(args.output_csv)
 
     if args.output_excel:
-        t.crea_excel(args.output_excel)
-        # Aggiunta grafici
-        if args.grafici:
-            t.aggiungi_grafici(args.output_excel)
+        t.crea_excel(args.output_excel, grafici=args.grafici)
 
     if len(dati_bollette) > 1:
         buchi = t.controlla_copertura()
@@ -4,64 +4,69 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 import calendar
 
 def load_and_process_data(csv_file: str):
     """Carica e processa i dati dal file CSV"""
-    df = pd.read_csv(csv_file)
-    
-    # Converte le date in formato datetime
-    df['periodo_inizio'] = pd.to_datetime(df['periodo_inizio'])
-    df['periodo_fine'] = pd.to_datetime(df['periodo_fine'])
+    # parse_dates fa convertire le date direttamente dal parser C di read_csv,
+    # senza un secondo passaggio pd.to_datetime sulle colonne stringa
+    df = pd.read_csv(csv_file, parse_dates=['periodo_inizio', 'periodo_fine'])
     print(f"Dati caricati: {len(df)} record dal {df['periodo_inizio'].min().strftime('%Y-%m-%d')} al {df['periodo_fine'].max().strftime('%Y-%m-%d')}")
     
     # Calcola il punto medio del periodo
     df['data_media'] = df['periodo_inizio'] + (df['periodo_fine'] - df['periodo_inizio']) / 2
     
-    # Calcola i giorni del periodo
-    df['giorni_periodo'] = (df['periodo_fine'] - df['periodo_inizio']).dt.days + 1
-    
-    # Normalizza rispetto al GIORNO le quantita che distribuiremo uniformemente
-    df['consumo_giornaliero_kwh'] = df['consumo_totale_kwh'] / df['giorni_periodo']
-    df['costo_materia_energia_giornaliero_eur'] = df['materia_energia_eur'] / df['giorni_periodo']
-    df['costo_totale_giornaliero_eur'] = df['totale_bolletta_eur'] / df['giorni_periodo']
+    # Calcola i giorni del periodo: sottrazione int64 su array datetime64[D]
+    # invece dell'accessor .dt.days (gli stessi array servono anche sotto per
+    # il riepilogo della copertura)
+    starts = df['periodo_inizio'].to_numpy().astype('datetime64[D]')
+    ends = df['periodo_fine'].to_numpy().astype('datetime64[D]')
+    df['giorni_periodo'] = ends.astype('int64') - starts.astype('int64') + 1
+
+    # Normalizza rispetto al GIORNO le quantita che distribuiremo uniformemente.
+    # float32 basta per kWh ed euro (l'output è mostrato con 1-2 decimali) e
+    # dimezza la memoria degli array usati nel broadcast per anno.
+    df['consumo_giornaliero_kwh'] = (df['consumo_totale_kwh'] / df['giorni_periodo']).astype(np.float32)
+    df['costo_materia_energia_giornaliero_eur'] = (df['materia_energia_eur'] / df['giorni_periodo']).astype(np.float32)
+    df['costo_totale_giornaliero_eur'] = (df['totale_bolletta_eur'] / df['giorni_periodo']).astype(np.float32)
     
-    # Informazioni sui periodi di fatturazione
+    # Informazioni sui periodi di fatturazione.
+    # Lavora su array di giorni int64 invece di iterrows + un set con un elemento
+    # per ogni giorno coperto: i giorni unici si ottengono fondendo gli intervalli
+    # ordinati, O(N log N) sui periodi invece di O(giorni totali).
     print("\nINFORMAZIONI PERIODI DI FATTURAZIONE")
     print("-" * 50)
     first_year = int(df['periodo_inizio'].min().year)
     last_year = int(df['periodo_fine'].max().year)
     for year in range(first_year, last_year + 1):
-        year_start = datetime(year, 1, 1)
-        year_end = datetime(year, 12, 31)
-
-        year_data = df[
-            (df['periodo_inizio'] <= year_end) &
-            (df['periodo_fine'] >= year_start)
-        ]
+        year_start = np.datetime64(f'{year}-01-01')
+        year_end = np.datetime64(f'{year}-12-31')
 
-        if len(year_data) == 0:
+        mask = (starts <= year_end) & (ends >= year_start)
+        num_periods = int(mask.sum())
+        if num_periods == 0:
             continue
 
-        num_periods = len(year_data)
-        sum_period_length = 0
-        covered_days = set()
+        clipped_start = np.maximum(starts[mask], year_start).astype('int64')
+        clipped_end = np.minimum(ends[mask], year_end).astype('int64')
+        sum_period_length = int((clipped_end - clipped_start + 1).sum())
 
-        for _, row in year_data.iterrows():
-            clipped_start = max(row['periodo_inizio'], year_start)
-            clipped_end = min(row['periodo_fine'], year_end)
-            if clipped_start > clipped_end:
-                continue
-
-            giorni_intersezione = (clipped_end - clipped_start).days + 1
-            sum_period_length += giorni_intersezione
-
-            for day in pd.date_range(clipped_start, clipped_end, freq='D'):
-                covered_days.add(day.date())
+        # Fusione degli intervalli ordinati per contare i giorni unici coperti
+        order = np.argsort(clipped_start)
+        unique_covered_days = 0
+        current_end = None
+        for s, e in zip(clipped_start[order], clipped_end[order]):
+            if current_end is None or s > current_end:
+                unique_covered_days += e - s + 1
+                current_end = e
+            elif e > current_end:
+                unique_covered_days += e - current_end
+                current_end = e
 
         days_in_year = 366 if calendar.isleap(year) else 365
-        unique_covered_days = len(covered_days)
         coverage = (unique_covered_days / days_in_year) * 100
 
         print(
@@ -71,153 +76,116 @@ def load_and_process_data(csv_file: str):
 
     return df
 
+@functools.lru_cache(maxsize=None)
 def get_week_dates(year: int):
-    """Restituisce le date di inizio e fine per ogni settimana dell'anno"""
+    """Restituisce le date di inizio e fine per ogni settimana dell'anno.
+       Il risultato è memoizzato: la tabella viene ricostruita identica per ogni
+       anno elaborato e non va mutata dai chiamanti."""
     weeks = []
-    
-    # Trova il primo lunedì dell'anno
-    first_day = datetime(year, 1, 1)
-    days_ahead = 0 - first_day.weekday()  # Lunedì è 0
-    if days_ahead <= 0:
-        days_ahead += 7
-    first_monday = first_day + timedelta(days=days_ahead)
-    
-    # Se il primo gennaio è già un lunedì o è nella prima settimana
-    if first_day.weekday() < 4:  # Se è da lunedì a giovedì
-        first_monday = first_day - timedelta(days=first_day.weekday())
-    
-    current_monday = first_monday
-    week_num = 1
-    
-    while current_monday.year <= year and week_num <= 52:
+
+    # Lunedì della settimana 1 secondo ISO 8601: la settimana che contiene il
+    # 4 gennaio (può iniziare negli ultimi giorni dell'anno precedente).
+    jan4 = datetime(year, 1, 4)
+    current_monday = jan4 - timedelta(days=jan4.weekday())
+
+    for week_num in range(1, 53):
+        # Ferma se la settimana inizierebbe nell'anno successivo
+        if current_monday.year > year:
+            break
+
         week_end = current_monday + timedelta(days=6)
-        
         # Assicurati che la settimana non vada oltre l'anno
         if week_end.year > year:
             week_end = datetime(year, 12, 31)
-        
+
         weeks.append({
             'settimana': week_num,
             'inizio': current_monday,
             'fine': week_end,
             'centro': current_monday + timedelta(days=3)
         })
-        
+
         current_monday += timedelta(days=7)
-        week_num += 1
-        
-        # Ferma se la nuova settimana inizierebbe nell'anno successivo
-        if current_monday.year > year:
-            break
-    
+
     return weeks
 
-def distribute_uniform_consumption(df, year: int):
-    """Distribuisce uniformemente i consumi dei periodi nelle settimane corrispondenti"""
-    # Filtra i dati per periodi che intersecano l'anno specificato
+@functools.lru_cache(maxsize=None)
+def _get_week_arrays(year: int):
+    """Inizi e fini delle settimane dell'anno come array int64 di giorni,
+       pre-convertiti una volta sola per anno per il broadcast NumPy."""
+    weeks = get_week_dates(year)
+    w_start_i = np.array([w['inizio'] for w in weeks], dtype='datetime64[D]').astype('int64')
+    w_end_i = np.array([w['fine'] for w in weeks], dtype='datetime64[D]').astype('int64')
+    return w_start_i, w_end_i
+
+def distribute_uniform_consumption(p_start_all, p_end_all,
+                                   daily_kwh_all, daily_materia_all, daily_totale_all,
+                                   year: int):
+    """Distribuisce uniformemente i consumi dei periodi nelle settimane corrispondenti.
+
+       Riceve gli array int64 di giorni e i valori giornalieri dell'intera
+       tabella (pre-calcolati una volta sola da process_all_years) invece del
+       DataFrame, così il filtro per anno è una maschera su array senza copy."""
+    # Seleziona i periodi che intersecano l'anno specificato
     # Include periodi che:
     # - iniziano nell'anno specificato, oppure
     # - finiscono nell'anno specificato, oppure
     # - iniziano prima e finiscono dopo (attraversano tutto l'anno)
-    year_start = datetime(year, 1, 1)
-    year_end = datetime(year, 12, 31)
-    
-    year_data = df[
-        (df['periodo_inizio'] <= year_end) & 
-        (df['periodo_fine'] >= year_start)
-    ].copy()
-    
-    if len(year_data) == 0:
+    year_start_i = np.datetime64(f'{year}-01-01').astype('int64')
+    year_end_i = np.datetime64(f'{year}-12-31').astype('int64')
+
+    mask = (p_start_all <= year_end_i) & (p_end_all >= year_start_i)
+    if not mask.any():
         return None
-    
+
     # Ottieni le settimane per l'anno
     weeks = get_week_dates(year)
-    
-    # Inizializza i risultati
-    weekly_results = {}
-    for week in weeks:
-        weekly_results[week['settimana']] = {
-            'settimana': week['settimana'],
-            'data_centro': week['centro'],
-            'periodo_inizio': week['inizio'],
-            'periodo_fine': week['fine'],
-            'consumo_totale_settimana_kwh': None,
-            'costo_totale_settimana_eur': None,
-            'costo_materia_energia_settimana_eur': None,
-            'giorni_totali_coperti': 0,
-            'periodi_che_intersecano': []
-        }
-    
-    # Per ogni periodo, distribuisce il consumo nelle settimane che interseca
-    for _, periodo in year_data.iterrows():
-        periodo_start = periodo['periodo_inizio']
-        periodo_end = periodo['periodo_fine']
-        
-        # Limita il periodo all'anno corrente per il calcolo
-        periodo_start_year = max(periodo_start, year_start)
-        periodo_end_year = min(periodo_end, year_end)
-        
-        # Se il periodo non interseca effettivamente l'anno, salta
-        if periodo_start_year > periodo_end_year:
-            continue
-        
-        # Trova tutte le settimane che intersecano questo periodo (limitato all'anno)
-        for week in weeks:
-            week_num = week['settimana']
-            week_start = week['inizio']
-            week_end = week['fine']
-            
-            # Calcola l'intersezione tra periodo (limitato all'anno) e settimana
-            intersection_start = max(periodo_start_year, week_start)
-            intersection_end = min(periodo_end_year, week_end)
-            
-            if intersection_start <= intersection_end:
-                # Calcola i giorni di intersezione
-                giorni_intersezione = (intersection_end - intersection_start).days + 1
-                
-                # Aggiungi il consumo di questi giorni alla settimana
-                consumo_settimana_kwh = periodo['consumo_giornaliero_kwh'] * giorni_intersezione
-                costo_materia_energia_settimana_eur = periodo['costo_materia_energia_giornaliero_eur']* giorni_intersezione
-                costo_totale_settimana_eur = periodo['costo_totale_giornaliero_eur']* giorni_intersezione
-
-                weekly_results[week_num]['periodi_che_intersecano'].append({
-                    'periodo_id': periodo.name,
-                    'periodo_start': periodo_start.strftime('%Y-%m-%d'),
-                    'periodo_end': periodo_end.strftime('%Y-%m-%d'),
-                    'giorni': giorni_intersezione,
-                    'consumo': consumo_settimana_kwh
-                })
-                
-                if giorni_intersezione > weekly_results[week_num]['giorni_totali_coperti']:
-                    # Rimpiazza i dati precedenti con queste ultime letture visto che probabilmente la bolletta
-                    # da cui vengono è una bolletta con ricalcolo di un periodo precedente già fatturato
-                    weekly_results[week_num]['consumo_totale_settimana_kwh'] = consumo_settimana_kwh
-                    weekly_results[week_num]['costo_materia_energia_settimana_eur'] = costo_materia_energia_settimana_eur
-                    weekly_results[week_num]['costo_totale_settimana_eur'] = costo_totale_settimana_eur
-                    weekly_results[week_num]['giorni_totali_coperti'] = giorni_intersezione
-
-    # Calcola i consumi finali per ogni settimana
-    results = []
-    for week_num, data in weekly_results.items():
-        daily_kwh = None
-        if data['giorni_totali_coperti']>0:
-            daily_kwh = data['consumo_totale_settimana_kwh']/data['giorni_totali_coperti']
-        
-        results.append({
-            'anno': year,
-            'settimana': week_num,
-            #'data_centro': data['data_centro'],
-            'periodo_inizio': data['periodo_inizio'],
-            'periodo_fine': data['periodo_fine'],
-            'consumo_giornaliero_kwh': daily_kwh,
-            'consumo_settimanale_kwh': data['consumo_totale_settimana_kwh'],
-            'costo_materia_energia_settimana_eur': data['costo_materia_energia_settimana_eur'],
-            'costo_totale_settimana_eur': data['costo_totale_settimana_eur'],
-            'giorni_coperti': data['giorni_totali_coperti'],
-            'num_periodi': len(data['periodi_che_intersecano'])
-        })
-    
-    return pd.DataFrame(results)
+
+    # Il doppio ciclo Python periodi × settimane è sostituito da un broadcast
+    # NumPy su array di giorni int64: la matrice N×W delle intersezioni viene
+    # calcolata in blocco, senza aritmetica su Timestamp per ogni cella.
+    # Periodi limitati all'anno corrente.
+    p_start_i = np.clip(p_start_all[mask], year_start_i, None)
+    p_end_i = np.clip(p_end_all[mask], None, year_end_i)
+
+    w_start_i, w_end_i = _get_week_arrays(year)
+
+    inter_start = np.maximum(p_start_i[:, None], w_start_i[None, :])
+    inter_end = np.minimum(p_end_i[:, None], w_end_i[None, :])
+    giorni = np.clip(inter_end - inter_start + 1, 0, None)  # matrice N×W
+
+    daily_kwh = daily_kwh_all[mask]
+    daily_materia = daily_materia_all[mask]
+    daily_totale = daily_totale_all[mask]
+
+    # Per ogni settimana vince il periodo con più giorni di intersezione (in caso
+    # di parità il primo in ordine di riga, come il rimpiazzo con '>' stretto del
+    # vecchio ciclo): probabilmente le letture più lunghe vengono da una bolletta
+    # con ricalcolo di un periodo precedente già fatturato.
+    num_periodi = (giorni > 0).sum(axis=0)
+    vincitore = giorni.argmax(axis=0)
+    idx_settimane = np.arange(len(weeks))
+    giorni_coperti = giorni[vincitore, idx_settimane]
+
+    # Colonne finali costruite in blocco dagli array (niente dict per settimana):
+    # le settimane senza copertura restano NaN, che il CSV scrive vuoto come
+    # faceva None. Restituisce un dict di array per colonna: process_all_years
+    # concatena colonna per colonna e materializza un solo DataFrame alla fine,
+    # invece di costruirne (e poi concatenarne) uno per anno.
+    coperta = giorni_coperti > 0
+    return {
+        'anno': np.full(len(weeks), year, dtype='int64'),
+        'settimana': np.array([w['settimana'] for w in weeks], dtype='int64'),
+        #'data_centro': [w['centro'] for w in weeks],
+        'periodo_inizio': np.array([w['inizio'] for w in weeks], dtype='datetime64[ns]'),
+        'periodo_fine': np.array([w['fine'] for w in weeks], dtype='datetime64[ns]'),
+        'consumo_giornaliero_kwh': np.where(coperta, daily_kwh[vincitore], np.nan),
+        'consumo_settimanale_kwh': np.where(coperta, daily_kwh[vincitore] * giorni_coperti, np.nan),
+        'costo_materia_energia_settimana_eur': np.where(coperta, daily_materia[vincitore] * giorni_coperti, np.nan),
+        'costo_totale_settimana_eur': np.where(coperta, daily_totale[vincitore] * giorni_coperti, np.nan),
+        'giorni_coperti': giorni_coperti,
+        'num_periodi': num_periodi,
+    }
 
 def process_all_years(df: pd.DataFrame):
     """Processa i dati anno per anno"""
@@ -225,57 +193,65 @@ def process_all_years(df: pd.DataFrame):
     # Ottieni gli anni disponibili nei dati
     years = sorted(df['periodo_inizio'].dt.year.unique())
 
-    # Crea le tracce per ogni anno
-    results = []
-    for year in years:
-        weekly_data = distribute_uniform_consumption(df, year)
-        if weekly_data is not None:
-            results.append(weekly_data)
-    #return pd.DataFrame(results)
-    return pd.concat(results, ignore_index=True)
+    # Array calcolati una volta sola sull'intera tabella: ogni anno li riusa
+    # con una maschera booleana invece di rifare filtro + copy sul DataFrame.
+    p_start_all = df['periodo_inizio'].to_numpy().astype('datetime64[D]').astype('int64')
+    p_end_all = df['periodo_fine'].to_numpy().astype('datetime64[D]').astype('int64')
+    daily_kwh_all = df['consumo_giornaliero_kwh'].to_numpy()
+    daily_materia_all = df['costo_materia_energia_giornaliero_eur'].to_numpy()
+    daily_totale_all = df['costo_totale_giornaliero_eur'].to_numpy()
+
+    # Crea le tracce per ogni anno; gli anni sono indipendenti e il grosso del
+    # lavoro è NumPy (che rilascia il GIL), quindi un pool di thread basta ed
+    # executor.map preserva l'ordine degli anni.
+    def _anno(year):
+        return distribute_uniform_consumption(
+            p_start_all, p_end_all,
+            daily_kwh_all, daily_materia_all, daily_totale_all, year)
+
+    if len(years) > 1:
+        with ThreadPoolExecutor() as executor:
+            results = [r for r in executor.map(_anno, years) if r is not None]
+    else:
+        results = [r for r in map(_anno, years) if r is not None]
+
+    # Un unico DataFrame dalle colonne concatenate di tutti gli anni
+    return pd.DataFrame({col: np.concatenate([r[col] for r in results])
+                         for col in results[0]})
 
 def generate_summary(interp_df: pd.DataFrame):
 
-    # Statistiche per settimana
-    weekly_stats_all_years = interp_df.groupby('settimana').agg({
-        'consumo_giornaliero_kwh': ['mean', 'std'],
-        'consumo_settimanale_kwh': ['mean', 'std'],
-        'giorni_coperti': 'mean'
-    }).round(2)
-    
+    # Statistiche per settimana: aggregazioni con nomi piatti invece del dict
+    # con colonne multi-indice, così il ciclo di stampa usa itertuples al posto
+    # di un lookup .loc[(colonna, statistica)] per ogni valore
+    weekly_stats_all_years = interp_df.groupby('settimana').agg(
+        media_giornaliera_kwh=('consumo_giornaliero_kwh', 'mean'),
+        dev_std_giornaliera_kwh=('consumo_giornaliero_kwh', 'std'),
+        media_settimanale_kwh=('consumo_settimanale_kwh', 'mean'),
+        dev_std_settimanale_kwh=('consumo_settimanale_kwh', 'std'),
+        media_giorni_coperti=('giorni_coperti', 'mean'),
+    ).round(2)
+
     print("\nSTATISTICHE PER SETTIMANA")
     print("-" * 50)
-    for week in weekly_stats_all_years.index:
-        mean_daily = weekly_stats_all_years.loc[week, ('consumo_giornaliero_kwh', 'mean')]
-        std_daily = weekly_stats_all_years.loc[week, ('consumo_giornaliero_kwh', 'std')]
-        mean_weekly = weekly_stats_all_years.loc[week, ('consumo_settimanale_kwh', 'mean')]
-        std_weekly = weekly_stats_all_years.loc[week, ('consumo_settimanale_kwh', 'std')]
-        #total_yearly = weekly_stats_all_years.loc[year, ('Consumo Totale (kWh)', 'sum')]
-        #total_days = weekly_stats_all_years.loc[year, ('giorni_periodo', 'sum')]
-        print(f"Settimana {week}: {mean_daily:.2f} ± {std_daily:.2f} kWh/giorno; {mean_weekly:.2f} ± {std_weekly:.2f} kWh/settimana")
-        #print(f"          Totale: {total_yearly:.1f} kWh in {total_days} giorni coperti")
-    
+    for riga in weekly_stats_all_years.itertuples():
+        print(f"Settimana {riga.Index}: {riga.media_giornaliera_kwh:.2f} ± {riga.dev_std_giornaliera_kwh:.2f} kWh/giorno; {riga.media_settimanale_kwh:.2f} ± {riga.dev_std_settimanale_kwh:.2f} kWh/settimana")
+
     # Statistiche per anno
-    yearly_stats = interp_df.groupby('anno').agg({
-        'costo_totale_settimana_eur': ['sum'], 
-        'costo_materia_energia_settimana_eur': ['sum'],
-        'consumo_giornaliero_kwh': ['sum'],
-        'consumo_settimanale_kwh': ['sum'],
-        'giorni_coperti': 'sum'
-    }).round(2)
-    
+    # NOTA: il consumo totale va sommato dai consumi settimanali, non dai
+    # giornalieri moltiplicati per 7: non tutte le settimane sono coperte per
+    # intero
+    yearly_stats = interp_df.groupby('anno').agg(
+        consumo_totale_kwh=('consumo_settimanale_kwh', 'sum'),
+        costo_totale_eur=('costo_totale_settimana_eur', 'sum'),
+        costo_materia_energia_eur=('costo_materia_energia_settimana_eur', 'sum'),
+        giorni_coperti=('giorni_coperti', 'sum'),
+    ).round(2)
+
     print("\nSTATISTICHE PER ANNO")
     print("-" * 50)
-    for year in yearly_stats.index:
-        # this is not accurate because not for all weeks we have full-week coverage, 7 days long:
-        #consumo_totale1 = yearly_stats.loc[year, ('consumo_giornaliero', 'sum')] * 7
-
-        consumo_totale2 = yearly_stats.loc[year, ('consumo_settimanale_kwh', 'sum')]
-        costo_totale_anno_eur = yearly_stats.loc[year, ('costo_totale_settimana_eur', 'sum')]
-        costo_materia_energia_anno_eur = yearly_stats.loc[year, ('costo_materia_energia_settimana_eur', 'sum')]
-        
-        giorni_coperti = yearly_stats.loc[year, ('giorni_coperti', 'sum')]
-        print(f"Anno {year}: Consumo totale: {consumo_totale2:.2f} kWh; Costo totale: {costo_totale_anno_eur}€; Costo materia energia: {costo_materia_energia_anno_eur}€ [copertura: {giorni_coperti}gg]")
+    for riga in yearly_stats.itertuples():
+        print(f"Anno {riga.Index}: Consumo totale: {riga.consumo_totale_kwh:.2f} kWh; Costo totale: {riga.costo_totale_eur}€; Costo materia energia: {riga.costo_materia_energia_eur}€ [copertura: {riga.giorni_coperti}gg]")
 
     print(yearly_stats.to_html(index=False))
 
@@ -1,67 +1,159 @@
 #!/usr/bin/env python3
 
 import argparse
-import pandas as pd
+import gzip
+import hashlib
+import os
+import numpy as np
 import json
 import calendar
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+# orjson (se installato) codifica il payload con un encoder nativo molto più
+# veloce di json e sa serializzare gli array NumPy direttamente dai loro
+# buffer C; in sua assenza si ricade sul json della libreria standard, che
+# converte gli eventuali array col gancio default
+try:
+    import orjson
+
+    def _dumps_json(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+except ImportError:
+    def _dumps_json(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                          default=lambda o: o.tolist())
+
+# Ambiente Jinja2 condiviso a livello di modulo: i template vengono
+# analizzati e compilati una volta sola (l'ambiente fa da cache per i
+# get_template successivi)
+_JINJA_ENV = None
+
+def _jinja_env():
+    global _JINJA_ENV
+    if _JINJA_ENV is None:
+        # auto_reload=False evita lo stat del file .j2 a ogni get_template;
+        # la bytecode cache in .cache/jinja conserva i template compilati tra
+        # una run e l'altra, saltando lexer/parser/compilazione a freddo
+        kwargs = {}
+        try:
+            jinja_cache_dir = os.path.join(".cache", "jinja")
+            os.makedirs(jinja_cache_dir, exist_ok=True)
+            kwargs["bytecode_cache"] = FileSystemBytecodeCache(jinja_cache_dir)
+        except OSError:
+            pass  # la cache è solo un'ottimizzazione: mai fallire per essa
+        _JINJA_ENV = Environment(loader=FileSystemLoader("templates"),
+                                 auto_reload=False, **kwargs)
+    return _JINJA_ENV
+
+
+def _apri_output(output_file):
+    """Apre il file HTML di output in scrittura testo; se il nome termina con
+       .gz scrive direttamente compresso (l'HTML generato è per lo più JSON e
+       si comprime di 5-10 volte)."""
+    if output_file.endswith('.gz'):
+        return gzip.open(output_file, 'wt', encoding='utf-8')
+    return open(output_file, 'w', encoding='utf-8')
+
+
+# Versione del formato della cache dei payload JSON: incrementare quando
+# cambia la struttura dei dati incorporati nelle pagine
+CACHE_VERSION = 1
+
+def _json_cache_path(csv_file, use_cache):
+    """Percorso del file di cache dei payload JSON per csv_file, o None se la
+       cache è disabilitata o il file non è accessibile."""
+    if not use_cache:
+        return None
+    try:
+        st = os.stat(csv_file)
+    except OSError:
+        return None
+    key = f"{os.path.abspath(csv_file)}|{st.st_mtime_ns}|{st.st_size}|{CACHE_VERSION}"
+    return os.path.join(".cache", "step3_" + hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
 
 def load_data(file_path):
+    # pandas viene importato solo qui: pesa centinaia di ms all'avvio e chi
+    # salta load_data (es. run con cache dei payload, o import del modulo)
+    # non deve pagarlo
+    import pandas as pd
+
     # Leggi il CSV
     # header atteso:
     #    anno,settimana,periodo_inizio,periodo_fine,consumo_giornaliero_kwh,consumo_settimanale_kwh,
     #    costo_materia_energia_settimana_eur,costo_totale_settimana_eur,giorni_coperti,num_periodi
-    return pd.read_csv(file_path)
+    # usecols limita parsing e memoria alle sole colonne usate dalle pagine
+    # (periodo_fine e num_periodi non servono)
+    return pd.read_csv(file_path, usecols=[
+        'anno', 'settimana', 'periodo_inizio',
+        'consumo_giornaliero_kwh', 'consumo_settimanale_kwh',
+        'costo_materia_energia_settimana_eur', 'costo_totale_settimana_eur',
+        'giorni_coperti',
+    ])
+
 
+def build_dati_json(df):
+    """Costruisce la stringa JSON con i dati settimanali per anno da
+       incorporare nella pagina interattiva."""
+    # Filtra solo le righe con dati validi (consumo_settimanale non nullo);
+    # dropna evita il giro maschera booleana + copy esplicito
+    df = df.dropna(subset=['consumo_settimanale_kwh'])
 
-def create_html_page(df, output_file):
-    # Filtra solo le righe con dati validi (consumo_settimanale non nullo)
-    df = df[df['consumo_settimanale_kwh'].notna()].copy()
+    # Arrotonda le colonne float una volta sola, con la ufunc np.round
+    # sull'array sottostante invece di Series.round gruppo per gruppo
+    colonne_float = ['consumo_giornaliero_kwh', 'consumo_settimanale_kwh',
+                     'costo_materia_energia_settimana_eur', 'costo_totale_settimana_eur']
+    for col in colonne_float:
+        df[col] = np.round(df[col].to_numpy(), 2)
 
-    # Prepara i dati per anno
-    anni_disponibili = sorted(df['anno'].unique())
+    # np.unique restituisce gli anni già ordinati in un solo passaggio C,
+    # senza il sorted() Python su una lista intermedia
+    anni_disponibili = np.unique(df['anno'].to_numpy())
     print(f"📊 Anni disponibili: {', '.join(map(str, anni_disponibili))}")
 
-    # Crea un dizionario con i dati per anno
+    # Crea un dizionario con i dati per anno: groupby(...).indices dà la mappa
+    # {anno: indici di riga} in un passaggio, le colonne vengono estratte una
+    # volta come array NumPy e affettate per gruppo, senza mai costruire
+    # DataFrame intermedi. Gli array numerici restano tali fino a _dumps_json
+    # (orjson li serializza dal buffer C, il fallback li converte con .tolist)
+    colonne_pagina = ['settimana', 'periodo_inizio', 'consumo_giornaliero_kwh',
+                      'consumo_settimanale_kwh', 'costo_materia_energia_settimana_eur',
+                      'costo_totale_settimana_eur', 'giorni_coperti']
+    colonne = {col: df[col].to_numpy() for col in colonne_pagina}
     dati_per_anno = {}
-    for anno in anni_disponibili:
-        df_anno = df[df['anno'] == anno]
+    for anno, idx in df.groupby('anno', sort=True).indices.items():
         dati_per_anno[str(anno)] = {
-            'settimane': df_anno['settimana'].tolist(),
-            'date': df_anno['periodo_inizio'].tolist(),
-            'consumo_giornaliero_kwh': df_anno['consumo_giornaliero_kwh'].round(2).tolist(),
-            'consumo_settimanale_kwh': df_anno['consumo_settimanale_kwh'].round(2).tolist(),
-            'costo_materia_energia_settimana_eur': df_anno['costo_materia_energia_settimana_eur'].round(2).tolist(),
-            'costo_totale_settimana_eur': df_anno['costo_totale_settimana_eur'].round(2).tolist(),
-            'giorni_coperti': df_anno['giorni_coperti'].tolist()
+            'settimane': colonne['settimana'][idx],
+            # date: array di stringhe, che gli encoder JSON vogliono come lista
+            'date': colonne['periodo_inizio'][idx].tolist(),
+            'consumo_giornaliero_kwh': colonne['consumo_giornaliero_kwh'][idx],
+            'consumo_settimanale_kwh': colonne['consumo_settimanale_kwh'][idx],
+            'costo_materia_energia_settimana_eur': colonne['costo_materia_energia_settimana_eur'][idx],
+            'costo_totale_settimana_eur': colonne['costo_totale_settimana_eur'][idx],
+            'giorni_coperti': colonne['giorni_coperti'][idx]
         }
 
-    # Template HTML da file
-    # Crea l'ambiente Jinja2 indicando dove trovare i template
-    env = Environment(loader=FileSystemLoader("templates"))
+    # JSON compatto (niente indent, che oltre a gonfiare l'HTML forza json su
+    # un percorso di codifica Python puro invece dell'encoder C)
+    return _dumps_json(dati_per_anno)
 
-    # Dati da passare al template
-    context = {
-        "dati_json": json.dumps(dati_per_anno, indent=2)
-    }
 
-    # Carica il template
-    template = env.get_template("html_template.j2")
-    # Renderizza il template con i dati
-    output = template.render(context)
+def create_html_page(dati_json, output_file):
+    # Carica il template HTML (compilato una volta sola dall'ambiente condiviso)
+    template = _jinja_env().get_template("html_template.j2")
 
-    # Salva il file HTML
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(output)
+    # Renderizza in streaming direttamente nel buffer del file, senza
+    # materializzare l'intera pagina come stringa in memoria
+    with _apri_output(output_file) as f:
+        template.stream({"dati_json": dati_json}).dump(f)
 
 
-def create_yearly_html_page(df, output_file):
-    """Crea una pagina HTML con un grafico annuale a doppio asse Y."""
-    df_valid = df[
-        df['consumo_settimanale_kwh'].notna() &
-        df['costo_totale_settimana_eur'].notna() &
-        df['giorni_coperti'].notna()
-    ].copy()
+def build_yearly_json(df):
+    """Costruisce la stringa JSON con i totali annuali (solo anni con
+       copertura > 90%) per il grafico a doppio asse Y."""
+    df_valid = df.dropna(subset=['consumo_settimanale_kwh',
+                                 'costo_totale_settimana_eur',
+                                 'giorni_coperti'])
 
     yearly = (
         df_valid.groupby('anno', as_index=False)
@@ -76,8 +168,9 @@ def create_yearly_html_page(df, output_file):
     yearly['giorni_anno'] = yearly['anno'].apply(lambda y: 366 if calendar.isleap(int(y)) else 365)
     yearly['copertura_percento'] = (yearly['giorni_coperti'] / yearly['giorni_anno']) * 100
 
-    # Include solo anni con copertura > 90%
-    yearly = yearly[yearly['copertura_percento'] > 90].copy()
+    # Include solo anni con copertura > 90%; nessuna mutazione a valle, quindi
+    # niente copia della selezione
+    yearly = yearly[yearly['copertura_percento'] > 90]
 
     yearly_data = {
         'anni': yearly['anno'].astype(int).tolist(),
@@ -86,16 +179,15 @@ def create_yearly_html_page(df, output_file):
         'copertura_percento': yearly['copertura_percento'].round(1).tolist(),
     }
 
-    env = Environment(loader=FileSystemLoader("templates"))
-    context = {
-        "yearly_json": json.dumps(yearly_data, indent=2)
-    }
+    return _dumps_json(yearly_data)
 
-    template = env.get_template("html_yearly_template.j2")
-    output = template.render(context)
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(output)
+def create_yearly_html_page(yearly_json, output_file):
+    """Crea una pagina HTML con un grafico annuale a doppio asse Y."""
+    template = _jinja_env().get_template("html_yearly_template.j2")
+
+    with _apri_output(output_file) as f:
+        template.stream({"yearly_json": yearly_json}).dump(f)
 
 
 def main():
@@ -114,27 +206,54 @@ def main():
     parser.add_argument(
         '-o', '--output-html',
         default='bollette_hera_riepilogo_interattivo.html',
-        help='Nome del file di output (default: bollette_hera_riepilogo_processato.html)'
+        help='Nome del file di output; con estensione .gz viene scritto compresso (default: bollette_hera_riepilogo_processato.html)'
     )
     parser.add_argument(
         '--output-yearly-html',
         default='bollette_hera_riepilogo_annuale.html',
         help='Nome del file HTML annuale (default: bollette_hera_riepilogo_annuale.html)'
     )
-    
+    parser.add_argument("--no-cache", help="Non riusare/salvare i payload JSON nella cartella .cache", action='store_true')
+
     args = parser.parse_args()
     csv_file = args.input
 
     try:
-        # Carica i dati
-        df = load_data(csv_file)
+        # Se il CSV di input non è cambiato (stesso percorso, mtime e
+        # dimensione) riusa i payload JSON calcolati in una run precedente:
+        # utile quando si rigenera la pagina dopo un ritocco al template
+        cache_file = _json_cache_path(csv_file, not args.no_cache)
+        payloads = None
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as f:
+                    payloads = json.load(f)
+            except (OSError, ValueError):
+                payloads = None
+
+        if payloads is None:
+            # Carica i dati e costruisci i payload JSON
+            df = load_data(csv_file)
+            payloads = {
+                "dati_json": build_dati_json(df),
+                "yearly_json": build_yearly_json(df),
+            }
+            if cache_file is not None:
+                try:
+                    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                    tmp_file = cache_file + ".tmp"
+                    with open(tmp_file, "w", encoding="utf-8") as f:
+                        json.dump(payloads, f)
+                    os.replace(tmp_file, cache_file)
+                except OSError:
+                    pass  # la cache è solo un'ottimizzazione: mai fallire per essa
 
         # Crea la pagina HTML
-        create_html_page(df, args.output_html)
+        create_html_page(payloads["dati_json"], args.output_html)
         print(f"✅ File HTML generato con successo: {args.output_html}")
 
         # Crea la pagina HTML annuale con doppio asse Y
-        create_yearly_html_page(df, args.output_yearly_html)
+        create_yearly_html_page(payloads["yearly_json"], args.output_yearly_html)
         print(f"✅ File HTML annuale generato con successo: {args.output_yearly_html}")
 
     except Exception as e: